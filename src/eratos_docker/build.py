@@ -1,6 +1,7 @@
 from pathlib import Path
 from typing import Optional, Annotated
-from .utils import register_model, get_registry_entry
+from .utils import register_model, get_registry_entry, R_LIBRARY_DIR
+import gzip
 import tarfile
 import zipfile
 import json
@@ -11,9 +12,13 @@ import argparse
 import shutil
 import sys
 import tempfile
+import threading
 import typer
 from colorama import Fore, Style
-from io import BytesIO
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from io import BufferedReader, BytesIO, RawIOBase
+from urllib.parse import urlparse
 
 BASE_IMAGE_MAP = {
     "6cd2f899-b5f1-444b-afbe-ee4a4eaec1bc": "senaps-prod/base-images/python3.10-base",
@@ -22,6 +27,25 @@ BASE_IMAGE_MAP = {
     "88bb0ad8-c24f-405c-890f-77a09a75926f": "base-images/r4",
 }
 URI_BASE = "public.ecr.aws/eratosio"
+# Posit Package Manager serves prebuilt linux binaries, which saves compiling from source
+R_REPO = "https://packagemanager.posit.co/cran/latest"
+R_LIBRARY = "/opt/r-lib"
+# only package manager instances serve binaries under __linux__/<codename>
+PACKAGE_MANAGER_HOSTS = {"packagemanager.posit.co", "packagemanager.rstudio.com"}
+# host-side R package cache, served to the build as a CRAN-like repository. Kept
+# below the analysis service ports the runner and scheduler count up from 18080
+R_CACHE_PORT = 18070
+# PACKAGES index fields R needs to resolve dependencies
+R_INDEX_FIELDS = [
+    "Package",
+    "Version",
+    "Depends",
+    "Imports",
+    "LinkingTo",
+    "Suggests",
+    "License",
+    "NeedsCompilation",
+]
 app = typer.Typer()
 
 
@@ -75,11 +99,211 @@ def extract_archive(path: Path, dst: Path):
             zip_ref.extractall(path=dst)
 
 
+def write_r_install_script(
+    path: Path,
+    packages: list[str],
+    repo: str,
+    binary: bool,
+    cache_url: Optional[str] = None,
+):
+    """
+    Write an R script installing any of `packages` not already in the image into
+    R_LIBRARY. When `binary` is set and `repo` is a Posit Package Manager instance,
+    the binary repository for the image's distro is used. Packages are taken from
+    the `cache_url` repository first, unless `repo` has a newer version.
+    """
+    lines = [
+        f"pkgs <- c({', '.join(json.dumps(p) for p in packages)})\n",
+        f'lib <- "{R_LIBRARY}"\n',
+        f"repo <- {json.dumps(repo)}\n",
+        "dir.create(lib, showWarnings = FALSE, recursive = TRUE)\n",
+    ]
+    if binary and urlparse(repo).hostname in PACKAGE_MANAGER_HOSTS:
+        lines += [
+            'release <- if (file.exists("/etc/os-release")) readLines("/etc/os-release") else character()\n',
+            'codename <- sub("^VERSION_CODENAME=", "", grep("^VERSION_CODENAME=", release, value = TRUE))\n',
+            'if (length(codename) == 1 && nzchar(codename) && !grepl("__linux__", repo, fixed = TRUE)) {\n',
+            '  repo <- sub("/cran/", paste0("/cran/__linux__/", codename, "/"), repo, fixed = TRUE)\n',
+            "}\n",
+            "# the package manager only serves binaries to clients that identify as R\n",
+            'options(HTTPUserAgent = sprintf("R/%s R (%s)", getRversion(), '
+            'paste(getRversion(), R.version["platform"], R.version["arch"], R.version["os"])))\n',
+        ]
+    if cache_url is not None:
+        # ties in version go to the first repository
+        lines.append(f"repos <- c(cache = {json.dumps(cache_url)}, CRAN = repo)\n")
+    else:
+        lines.append("repos <- c(CRAN = repo)\n")
+    lines += [
+        "missing <- setdiff(pkgs, rownames(installed.packages()))\n",
+        "if (length(missing) > 0) {\n",
+        "  install.packages(missing, lib = lib, repos = repos, Ncpus = parallel::detectCores())\n",
+        "}\n",
+        "missing <- setdiff(pkgs, rownames(installed.packages()))\n",
+        'if (length(missing) > 0) stop("Failed to install R packages: ", paste(missing, collapse = ", "))\n',
+    ]
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def parse_dcf(text: str) -> dict[str, str]:
+    """Parse a single R DESCRIPTION style record."""
+    fields = {}
+    key = None
+    for line in text.splitlines():
+        if line[:1].isspace() and key is not None:
+            fields[key] += " " + line.strip()
+        elif ":" in line:
+            key, _, value = line.partition(":")
+            key = key.strip()
+            fields[key] = value.strip()
+    return fields
+
+
+def get_r_cache_dir(docker_client: docker.APIClient, base_image_uri: str) -> Path:
+    """
+    Host-side R package cache for a base image. It's keyed by the image id, so
+    packages are only reused against the R version and system libraries they
+    were compiled against.
+    """
+    try:
+        image_id = docker_client.inspect_image(base_image_uri)["Id"]
+    except docker.errors.ImageNotFound:
+        docker_client.pull(base_image_uri, platform="linux/amd64")
+        image_id = docker_client.inspect_image(base_image_uri)["Id"]
+    return Path(R_LIBRARY_DIR) / image_id.removeprefix("sha256:")[:12]
+
+
+def write_r_cache_index(contrib_dir: Path):
+    """Write the PACKAGES index for the cached packages in `contrib_dir`."""
+    records = []
+    for tarball in sorted(contrib_dir.glob("*.tar.gz")):
+        package = tarball.name.partition("_")[0]
+        with tarfile.open(tarball, "r:gz") as tar:
+            description = tar.extractfile(f"{package}/DESCRIPTION").read()
+        fields = parse_dcf(description.decode("utf-8", errors="replace"))
+        records.append(
+            "".join(
+                f"{field}: {fields[field]}\n"
+                for field in R_INDEX_FIELDS
+                if field in fields
+            )
+        )
+    with open(contrib_dir / "PACKAGES", "w") as f:
+        f.write("\n".join(records))
+
+
+class ChunkReader(RawIOBase):
+    """File-like view of a stream of byte chunks, such as docker archives."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def cache_r_library(docker_client: docker.APIClient, image: str, cache_dir: Path):
+    """
+    Add any R packages installed into `image` that aren't cached yet to the
+    host-side cache, as binary package tarballs (the same format
+    `R CMD INSTALL --build` produces).
+    """
+    contrib_dir = cache_dir / "src" / "contrib"
+    os.makedirs(contrib_dir, exist_ok=True)
+    container_id = docker_client.create_container(image).get("Id")
+    try:
+        # stream the library once, only reading package versions
+        new_packages = {}
+        stream, _ = docker_client.get_archive(container_id, R_LIBRARY)
+        with tarfile.open(
+            fileobj=BufferedReader(ChunkReader(stream)), mode="r|"
+        ) as tar:
+            for member in tar:
+                parts = member.name.split("/")
+                if not (
+                    member.isfile() and len(parts) == 3 and parts[2] == "DESCRIPTION"
+                ):
+                    continue
+                description = tar.extractfile(member).read()
+                version = parse_dcf(description.decode("utf-8", errors="replace"))[
+                    "Version"
+                ]
+                tarball = contrib_dir / f"{parts[1]}_{version}.tar.gz"
+                if not tarball.exists():
+                    new_packages[parts[1]] = tarball
+
+        # docker archives a package as a tar of `<package>/`, so compressing it
+        # gives the binary package without extracting anything
+        for package, tarball in new_packages.items():
+            stream, _ = docker_client.get_archive(
+                container_id, f"{R_LIBRARY}/{package}"
+            )
+            partial_tarball = tarball.with_name(tarball.name + ".part")
+            with gzip.open(partial_tarball, "wb") as f:
+                for chunk in stream:
+                    f.write(chunk)
+            os.replace(partial_tarball, tarball)
+    finally:
+        docker_client.remove_container(container_id, v=True, force=True)
+    if len(new_packages) > 0:
+        write_r_cache_index(contrib_dir)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format_, *log_args):
+        pass  # Inhibit log messages.
+
+
+def serve_r_cache(cache_dir: Path, port: int) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve the R package cache to builds, until the server is shut down. Returns
+    None if the port can't be bound, in which case the build goes without.
+    """
+    os.makedirs(cache_dir / "src" / "contrib", exist_ok=True)
+    if not (cache_dir / "src" / "contrib" / "PACKAGES").exists():
+        write_r_cache_index(cache_dir / "src" / "contrib")
+    try:
+        httpd = ThreadingHTTPServer(
+            ("0.0.0.0", port), partial(QuietHandler, directory=cache_dir)
+        )
+    except OSError as e:
+        print(
+            f"{Fore.YELLOW}Could not serve the R package cache on port {port} ({e}), "
+            f"building without it. Use --r-cache-port to pick another port.{Style.RESET_ALL}"
+        )
+        return None
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
 @app.command("build")
 def build(
     path: Path,
     tag: Annotated[str, typer.Option(help="tag for image, else latest")] = "latest",
     repo_name: Annotated[Optional[str], typer.Option(help="repo name of image")] = None,
+    r_repo: Annotated[str, typer.Option(help="CRAN repository for R packages")] = R_REPO,
+    r_binary: Annotated[
+        bool, typer.Option(help="prefer prebuilt binary R packages when available")
+    ] = True,
+    r_cache: Annotated[
+        bool, typer.Option(help="reuse compiled R packages across builds")
+    ] = True,
+    r_cache_port: Annotated[
+        int, typer.Option(help="port to serve the R package cache to builds on")
+    ] = R_CACHE_PORT,
 ):
     docker_client = docker.APIClient(base_url=get_docker_base_url())
     os.makedirs("docker", exist_ok=True)
@@ -110,7 +334,7 @@ def build(
     # resolve dependencies
     pip_deps = []
     apt_deps = []
-    # todo R
+    r_deps = []
     entrypoint = manifest["entrypoint"]
     for entry in manifest["dependencies"]:
         match entry["provider"]:
@@ -118,9 +342,17 @@ def build(
                 pip_deps.append(entry["name"])
             case "APT":
                 apt_deps.append(entry["name"])
+            case "CRAN":
+                r_deps.append(entry["name"])
             case _:
                 raise ValueError(f"Invalid dependency provider {entry['provider']}")
 
+    r_script_path = dockerfile_dir / f"{dockerfile_name}.install.R"
+    r_cache_httpd = None
+    if len(r_deps) > 0 and r_cache:
+        r_cache_dir = get_r_cache_dir(docker_client, base_image_uri)
+        r_cache_httpd = serve_r_cache(r_cache_dir, r_cache_port)
+
     print("Building dockerfile")
     with open(dockerfile_path, "w") as f:
         # see https://github.com/eratosio/analysis-service-api/blob/eratos-develop/docker/src/main/java/au/csiro/sensorcloud/analysis/docker/EcsRuntimeManager.java#L261
@@ -128,20 +360,42 @@ def build(
             [
                 f"# Automatically generated docker file for {path.as_posix()} on\n",
                 f"FROM {base_image_uri}\n",
-                f"COPY {model_path} /opt/model/\n",
             ]
         )
+        # Install dependencies before copying the model, so that their layers stay
+        # cached while the model changes
         if len(apt_deps) > 0:
             f.write(
                 f"RUN apt-get -y -q update && DEBIAN_FRONTEND=noninteractive apt-get -y -q install {' '.join(apt_deps)}\n"
             )
 
+        if len(r_deps) > 0:
+            # the script is the cache key for this layer, so keep it stable
+            write_r_install_script(
+                r_script_path,
+                sorted(r_deps),
+                r_repo,
+                r_binary,
+                (
+                    f"http://host.docker.internal:{r_cache_port}"
+                    if r_cache_httpd is not None
+                    else None
+                ),
+            )
+            f.write(f"ENV R_LIBS={R_LIBRARY}\n")
+            f.writelines(
+                [
+                    f"COPY {r_script_path.as_posix()} /tmp/install.R\n",
+                    "RUN Rscript /tmp/install.R && rm /tmp/install.R\n",
+                ]
+            )
+
         if len(pip_deps) > 0:
             f.write(f"RUN pip install --no-cache-dir {' '.join(pip_deps)}\n")
 
         f.writelines(
             [
-                # Install dependencies
+                f"COPY {model_path} /opt/model/\n",
                 "RUN python3 -OO -m compileall /opt/model/\n",
                 "WORKDIR /opt/model\n",
                 f"ENTRYPOINT python3 -m as_models host /opt/model/{entrypoint}\n",
@@ -163,16 +417,29 @@ def build(
         f"{Fore.RED}!{Fore.BLACK} denote STDERR output.){Style.RESET_ALL}\n"
     )
 
-    for line in docker_client.build(
-        path=".",
-        dockerfile=dockerfile_path.as_posix(),
-        platform="linux/amd64",
-        tag=f"{repo_name}:{tag}",
-    ):
-        try:
-            print_lines(get_client_output_lines(line))
-        except Exception as e:
-            print(line)
+    build_failed = False
+    try:
+        for line in docker_client.build(
+            path=".",
+            dockerfile=dockerfile_path.as_posix(),
+            platform="linux/amd64",
+            tag=f"{repo_name}:{tag}",
+            extra_hosts={"host.docker.internal": "host-gateway"},
+        ):
+            try:
+                lines = get_client_output_lines(line)
+                build_failed = build_failed or any("error" in l for l in lines)
+                print_lines(lines)
+            except Exception as e:
+                print(line)
+    finally:
+        if r_cache_httpd is not None:
+            r_cache_httpd.shutdown()
+            r_cache_httpd.server_close()
+
+    if len(r_deps) > 0 and r_cache and not build_failed:
+        print(f"Caching compiled R packages in {r_cache_dir}")
+        cache_r_library(docker_client, f"{repo_name}:{tag}", r_cache_dir)
 
     return 0
 
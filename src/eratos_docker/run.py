@@ -4,7 +4,12 @@ import json
 import time
 import platform
 import pprint
+import pstats
+import tarfile
+import threading
 import multiprocessing
+from io import BytesIO
+from .build import get_client_output_lines, print_lines
 from .mock_analysis import MockAnalysisService
 from .utils import get_registry_entry
 from uuid import uuid4
@@ -25,6 +30,12 @@ COLOURS = {
 
 TIMESTAMP_COLOUR = Fore.CYAN
 
+PROFILERS = {"cprofile", "py-spy"}
+# where profiles are written inside the container, before being copied out
+PROFILE_DIR = "/tmp"
+# records which model image a profiling image was built from
+PROFILE_BASE_LABEL = "eratos.profile.base-image"
+
 
 def format_status(status):
     logs = status.get("log")
@@ -42,6 +53,58 @@ def format_status(status):
             )
 
 
+def summarise_cprofile(path: Path, limit: int) -> list[dict[str, Any]]:
+    """Hottest functions in a cProfile dump, by time spent in the function itself."""
+    stats = pstats.Stats(path.as_posix()).stats
+    functions = [
+        {
+            "function": f"{func} ({filename}:{line})",
+            "calls": calls,
+            "self_time": self_time,
+            "cumulative_time": cumulative_time,
+        }
+        for (filename, line, func), (
+            _,
+            calls,
+            self_time,
+            cumulative_time,
+            _,
+        ) in stats.items()
+    ]
+    functions.sort(key=lambda f: f["self_time"], reverse=True)
+    return functions[:limit]
+
+
+def summarise_pyspy(path: Path, limit: int) -> list[dict[str, Any]]:
+    """Hottest functions in py-spy's raw (collapsed stack) output, by self samples."""
+    self_samples = {}
+    total_samples = {}
+    sample_count = 0
+    with open(path, "r") as f:
+        for line in f:
+            stack, _, count = line.strip().rpartition(" ")
+            if not stack:
+                continue
+            count = int(count)
+            sample_count += count
+            frames = stack.split(";")
+            self_samples[frames[-1]] = self_samples.get(frames[-1], 0) + count
+            # recursive frames only count once towards the total
+            for frame in set(frames):
+                total_samples[frame] = total_samples.get(frame, 0) + count
+    functions = [
+        {
+            "function": frame,
+            "self_samples": self_samples.get(frame, 0),
+            "total_samples": total,
+            "self_percent": 100.0 * self_samples.get(frame, 0) / sample_count,
+        }
+        for frame, total in total_samples.items()
+    ]
+    functions.sort(key=lambda f: f["self_samples"], reverse=True)
+    return functions[:limit]
+
+
 class ModelRunner:
     def __init__(
         self,
@@ -50,6 +113,8 @@ class ModelRunner:
     ):
         self.model_path = model_path
         self.docker_client = docker_client
+        # jobs sharing a runner would otherwise build the profiling image at once
+        self.profiling_image_lock = threading.Lock()
 
         self.model_path = Path(self.model_path)
         if not self.model_path.exists():
@@ -57,6 +122,7 @@ class ModelRunner:
         model_cfg = get_registry_entry(self.model_path.resolve().as_posix())
         self.image_name = model_cfg["image"]
         manifest = model_cfg["manifest"]
+        self.entrypoint = manifest["entrypoint"]
 
         models = manifest["models"]
         self.model_ids = []
@@ -73,6 +139,54 @@ class ModelRunner:
             )
             return False
 
+    def build_profiling_image(self) -> str:
+        """
+        Build a variant of the model image with py-spy installed, unless one was
+        already built from the current model image.
+        """
+        image = f"{self.image_name}:profile"
+        with self.profiling_image_lock:
+            base_image_id = self.docker_client.inspect_image(self.image_name)["Id"]
+            try:
+                labels = self.docker_client.inspect_image(image)["Config"]["Labels"]
+                if (labels or {}).get(PROFILE_BASE_LABEL) == base_image_id:
+                    return image
+            except docker.errors.ImageNotFound:
+                pass
+
+            dockerfile = (
+                f"FROM {self.image_name}\nRUN pip install --no-cache-dir py-spy\n"
+            )
+            print(f"Building profiling image {image}")
+            for line in self.docker_client.build(
+                fileobj=BytesIO(dockerfile.encode("utf-8")),
+                platform="linux/amd64",
+                tag=image,
+                labels={PROFILE_BASE_LABEL: base_image_id},
+            ):
+                try:
+                    print_lines(get_client_output_lines(line))
+                except Exception as e:
+                    print(line)
+        return image
+
+    def copy_profile(self, container_id: str, profile_name: str, profile_dir: Path):
+        """
+        Copy a profile out of the container. Bind mounts would only work for
+        containers on the local docker host.
+        """
+        try:
+            stream, _ = self.docker_client.get_archive(
+                container_id, f"{PROFILE_DIR}/{profile_name}"
+            )
+        except docker.errors.NotFound:
+            return
+        with tarfile.open(fileobj=BytesIO(b"".join(stream))) as tar:
+            # only take the profile itself, whatever else the archive says
+            member = tar.getmember(profile_name)
+            with open(profile_dir / profile_name, "wb") as f:
+                f.write(tar.extractfile(member).read())
+
     def run_model(
         self,
         initial_ports: Optional[dict[str, Any]] = None,
@@ -84,11 +198,28 @@ class ModelRunner:
         senaps_host: Optional[str] = None,
         expose_ports: Optional[list[int]] = None,
         senaps_api_key: Optional[str] = None,
+        model_host: str = "localhost",
+        analysis_service_host: str = "host.docker.internal",
+        profile: bool = False,
+        profiler: str = "cprofile",
+        profile_dir: Optional[str | Path] = None,
+        profile_limit: int = 20,
     ):
-        # Spin up a mock Analysis Service to capture uploaded documents.
-        httpd = MockAnalysisService(analysis_service_port)
-        httpd.documents = {}
-        httpd.timeout = 0.1
+        """
+        Run the model against a mock analysis service, returning the resulting
+        documents and any model errors.
+
+        With `profile` set the model entrypoint is run under `profiler` (cProfile,
+        or py-spy from a profiling variant of the image, which also samples
+        threads and subprocesses). The profile is copied to `profile_dir` on
+        the host, and a summary of the `profile_limit` hottest functions is
+        returned as a third value: `result_docs, model_errors, profile_summary`.
+        """
+        if profile and profiler not in PROFILERS:
+            raise ValueError(
+                f"Invalid profiler {profiler}, expected one of {PROFILERS}"
+            )
+
         # build context object
         if id is None:
             # default to first model
@@ -102,7 +233,7 @@ class ModelRunner:
         job_request = {
             "modelId": id,
             "analysisServicesConfiguration": {
-                "url": f"http://host.docker.internal:{analysis_service_port}/api/analysis"
+                "url": f"http://{analysis_service_host}:{analysis_service_port}/api/analysis"
             },
         }
 
@@ -151,6 +282,49 @@ class ModelRunner:
             else:
                 bind_mounts.update({self.model_path.resolve().as_posix(): "/opt/model"})
 
+        image = self.image_name
+        entrypoint = None
+        cap_add = None
+        if profile:
+            if profile_dir is None:
+                profile_dir = Path.cwd() / "profiles"
+            profile_dir = Path(profile_dir).resolve()
+            profile_dir.mkdir(parents=True, exist_ok=True)
+
+            command = [
+                "python3",
+                "-m",
+                "as_models",
+                "host",
+                f"/opt/model/{self.entrypoint}",
+            ]
+            profile_name = f"{id}-{uuid4()}"
+            if profiler == "cprofile":
+                profile_name += ".prof"
+                # cProfile takes the place of `python3 -m`
+                entrypoint = (
+                    command[:1]
+                    + ["-m", "cProfile", "-o", f"{PROFILE_DIR}/{profile_name}"]
+                    + command[1:]
+                )
+            else:
+                profile_name += ".txt"
+                image = self.build_profiling_image()
+                entrypoint = [
+                    "py-spy",
+                    "record",
+                    "--subprocesses",
+                    "--format",
+                    "raw",
+                    # group samples by function rather than by line
+                    "--nolineno",
+                    "--output",
+                    f"{PROFILE_DIR}/{profile_name}",
+                    "--",
+                ] + command
+                # py-spy reads the memory of the process it samples
+                cap_add = ["SYS_PTRACE"]
+
         if bind_mounts is not None:
             binds = {
                 host_dir: {"bind": container_dir, "mode": "rw"}
@@ -166,6 +340,7 @@ class ModelRunner:
             port_bindings={model_port: model_port},
             extra_hosts={"host.docker.internal": "host-gateway"},
             binds=binds,
+            cap_add=cap_add,
         )
 
         if expose_ports is None:
@@ -173,22 +348,35 @@ class ModelRunner:
         else:
             ports = [model_port] + expose_ports
 
-        container = self.docker_client.create_container(
-            self.image_name,
-            host_config=host_config,
-            detach=True,
-            ports=ports,
-            volumes=volumes,
-            environment={"MODEL_PORT": f"{model_port}", "MODEL_HOST": "0.0.0.0"},
-            tty=True,
-            platform="linux/amd64",
-        )
-        container_id = container.get("Id")
-        self.docker_client.start(container_id)
+        # Spin up a mock Analysis Service to capture uploaded documents.
+        httpd = MockAnalysisService(analysis_service_port)
+        httpd.documents = {}
+        httpd.timeout = 0.1
+
+        container_id = None
+        try:
+            container = self.docker_client.create_container(
+                image,
+                host_config=host_config,
+                detach=True,
+                ports=ports,
+                volumes=volumes,
+                environment={"MODEL_PORT": f"{model_port}", "MODEL_HOST": "0.0.0.0"},
+                tty=True,
+                platform="linux/amd64",
+                entrypoint=entrypoint,
+            )
+            container_id = container.get("Id")
+            self.docker_client.start(container_id)
+        except Exception:
+            httpd.server_close()
+            if container_id is not None:
+                self.docker_client.remove_container(container_id, v=True, force=True)
+            raise
 
         print("Model container running: {}".format(container_id))
 
-        model_url = f"http://localhost:{model_port}/"
+        model_url = f"http://{model_host}:{model_port}/"
 
         status = None
         model_errors = None
@@ -254,6 +442,9 @@ class ModelRunner:
             )
             raise
         finally:
+            # free the port straight away, rather than whenever this frame is collected
+            httpd.server_close()
+
             border = "=" * 40
             print(
                 f"{Style.BRIGHT}{border} {Fore.CYAN}DOCKER LOG{Fore.BLACK} {border}{Style.RESET_ALL}"
@@ -266,6 +457,17 @@ class ModelRunner:
                 f"{Style.BRIGHT}{border} {Fore.CYAN}DOCKER LOG{Fore.BLACK} {border}{Style.RESET_ALL}"
             )
 
+            if profile:
+                # profilers only write their output once the model exits, which
+                # `stop` would otherwise cut short
+                try:
+                    self.docker_client.wait(container_id, timeout=30)
+                except requests.exceptions.RequestException:
+                    print(
+                        "Timed out waiting for model to exit, profile may be missing"
+                    )
+                self.copy_profile(container_id, profile_name, profile_dir)
+
             # Wait 10 seconds for container to exit, then clean up.
             print("Killing container")
             self.docker_client.stop(container_id, timeout=10)
@@ -286,4 +488,22 @@ class ModelRunner:
         else:
             print("Errors: none")
 
+        if profile:
+            profile_path = profile_dir / profile_name
+            if not profile_path.exists():
+                print(f"No profile was written to {profile_path}")
+                functions = []
+            elif profiler == "cprofile":
+                functions = summarise_cprofile(profile_path, profile_limit)
+            else:
+                functions = summarise_pyspy(profile_path, profile_limit)
+            profile_summary = {
+                "profiler": profiler,
+                "path": profile_path.as_posix(),
+                "functions": functions,
+            }
+            print(f"Profile written to {profile_path}. Hot functions:")
+            pprint.pprint(functions, indent=4, sort_dicts=False)
+            return result_docs, model_errors, profile_summary
+
         return result_docs, model_errors
@@ -0,0 +1,265 @@
+import docker
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+from urllib.parse import urlparse
+from .build import get_docker_base_url
+from .run import ModelRunner
+from .utils import get_registry_entry
+
+
+def get_host_address(base_url: str) -> str:
+    """Address model ports are reachable at for a given docker endpoint."""
+    parsed = urlparse(base_url)
+    if parsed.scheme in ("tcp", "http", "https", "ssh") and parsed.hostname:
+        return parsed.hostname
+    # unix sockets and named pipes are local
+    return "localhost"
+
+
+class DockerHost:
+    def __init__(
+        self,
+        base_url: str,
+        max_concurrency: int = 1,
+        docker_client: Optional[docker.APIClient] = None,
+        address: Optional[str] = None,
+        callback_host: str = "host.docker.internal",
+        model_port: int = 28080,
+    ):
+        """
+        A docker endpoint jobs can be placed on.
+
+        `address` is where model ports published on the host can be reached from
+        here, `callback_host` is where the mock analysis service on this machine
+        can be reached from inside containers running on the host.
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.docker_client = (
+            docker_client
+            if docker_client is not None
+            # an explicit version stops the client contacting the daemon here, so a
+            # host that is down is only marked unhealthy once the batch starts
+            else docker.APIClient(
+                base_url=base_url, version=docker.constants.DEFAULT_DOCKER_API_VERSION
+            )
+        )
+        self.address = address if address is not None else get_host_address(base_url)
+        self.callback_host = callback_host
+        self.free_ports = list(range(model_port, model_port + max_concurrency))
+
+        self.healthy = True
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.last_error = None
+
+    @property
+    def load(self) -> float:
+        return self.active / self.max_concurrency
+
+    def stats(self, wall_time: float) -> dict[str, Any]:
+        capacity = wall_time * self.max_concurrency
+        return {
+            "base_url": self.base_url,
+            "max_concurrency": self.max_concurrency,
+            "healthy": self.healthy,
+            "completed": self.completed,
+            "failed": self.failed,
+            "busy_time": self.busy_time,
+            "utilisation": self.busy_time / capacity if capacity > 0 else 0.0,
+            "last_error": self.last_error,
+        }
+
+
+def ensure_image(
+    image_name: str,
+    docker_client: docker.APIClient,
+    source_client: Optional[docker.APIClient] = None,
+):
+    """
+    Make sure `image_name` exists on the host behind `docker_client`. The image is
+    copied over from `source_client` if it has it, otherwise pulled from its registry.
+    """
+    try:
+        docker_client.inspect_image(image_name)
+        return
+    except docker.errors.ImageNotFound:
+        pass
+
+    if source_client is not None:
+        try:
+            source_client.inspect_image(image_name)
+        except docker.errors.ImageNotFound:
+            source_client = None
+
+    if source_client is not None:
+        print(f"Loading {image_name} onto {docker_client.base_url}")
+        docker_client.load_image(source_client.get_image(image_name))
+    else:
+        print(f"Pulling {image_name} onto {docker_client.base_url}")
+        repository, tag = docker.utils.parse_repository_tag(image_name)
+        docker_client.pull(repository, tag=tag or "latest")
+    # raises ImageNotFound if neither worked
+    docker_client.inspect_image(image_name)
+
+
+class ModelScheduler:
+    def __init__(
+        self,
+        model_path: str | Path,
+        hosts: list[DockerHost],
+        max_retries: int = 2,
+        analysis_service_port: int = 18080,
+        source_client: Optional[docker.APIClient] = None,
+    ):
+        """
+        Runs batches of `ModelRunner.run_model` jobs across several docker hosts,
+        placing each job on the least loaded healthy host.
+        """
+        if len(hosts) == 0:
+            raise ValueError("At least one docker host is required")
+        self.model_path = Path(model_path)
+        if not self.model_path.exists():
+            raise FileNotFoundError(f"{model_path} does not exist!")
+        self.image_name = get_registry_entry(self.model_path.resolve().as_posix())[
+            "image"
+        ]
+        self.hosts = hosts
+        self.max_retries = max_retries
+        self.source_client = (
+            source_client
+            if source_client is not None
+            else docker.APIClient(base_url=get_docker_base_url())
+        )
+
+        # every concurrent job needs its own mock analysis service on this machine
+        slots = sum(h.max_concurrency for h in hosts)
+        self.free_analysis_ports = list(
+            range(analysis_service_port, analysis_service_port + slots)
+        )
+        self.runners: dict[str, ModelRunner] = {}
+        self.cond = threading.Condition()
+
+    def mark_unhealthy(self, host: DockerHost, err: str):
+        with self.cond:
+            host.healthy = False
+            host.last_error = err
+            self.cond.notify_all()
+        print(f"Docker host {host.base_url} failed: {err}")
+
+    def prepare_hosts(self):
+        for host in self.hosts:
+            if not host.healthy:
+                continue
+            try:
+                ensure_image(self.image_name, host.docker_client, self.source_client)
+                self.runners[host.base_url] = ModelRunner(
+                    self.model_path, host.docker_client
+                )
+            except Exception as e:
+                self.mark_unhealthy(host, f"{e.__class__.__name__}: {e}")
+
+    def host_alive(self, host: DockerHost) -> bool:
+        try:
+            return host.docker_client.ping()
+        except Exception:
+            return False
+
+    def acquire(self) -> tuple[DockerHost, int, int]:
+        with self.cond:
+            while True:
+                candidates = [
+                    h
+                    for h in self.hosts
+                    if h.healthy and h.active < h.max_concurrency
+                ]
+                if candidates:
+                    host = min(candidates, key=lambda h: h.load)
+                    host.active += 1
+                    return host, host.free_ports.pop(), self.free_analysis_ports.pop()
+                if not any(h.healthy for h in self.hosts):
+                    raise RuntimeError("No healthy docker hosts available")
+                self.cond.wait()
+
+    def release(self, host: DockerHost, model_port: int, analysis_port: int):
+        with self.cond:
+            host.active -= 1
+            host.free_ports.append(model_port)
+            self.free_analysis_ports.append(analysis_port)
+            self.cond.notify_all()
+
+    def run_job(self, job: dict[str, Any]) -> dict[str, Any]:
+        result = {
+            "host": None,
+            "attempts": 0,
+            "result_docs": None,
+            "model_errors": None,
+            "profile": None,
+            "error": None,
+        }
+        while result["attempts"] <= self.max_retries:
+            try:
+                host, model_port, analysis_port = self.acquire()
+            except RuntimeError as e:
+                result["error"] = str(e)
+                break
+            result["host"] = host.base_url
+            result["attempts"] += 1
+            start = time.monotonic()
+            try:
+                outputs = self.runners[host.base_url].run_model(
+                    **job,
+                    model_port=model_port,
+                    analysis_service_port=analysis_port,
+                    model_host=host.address,
+                    analysis_service_host=host.callback_host,
+                )
+            except Exception as e:
+                # only keep the message, the traceback holds on to the job's frames
+                result["error"] = f"{e.__class__.__name__}: {e}"
+                with self.cond:
+                    host.failed += 1
+                if self.host_alive(host):
+                    # the job itself failed, it would fail on any other host too
+                    break
+                self.mark_unhealthy(host, result["error"])
+                continue
+            finally:
+                with self.cond:
+                    host.busy_time += time.monotonic() - start
+                self.release(host, model_port, analysis_port)
+
+            with self.cond:
+                host.completed += 1
+            if job.get("profile", False):
+                docs, errors, result["profile"] = outputs
+            else:
+                docs, errors = outputs
+            result["result_docs"], result["model_errors"] = docs, errors
+            result["error"] = None
+            break
+        return result
+
+    def run_batch(
+        self, jobs: list[dict[str, Any]]
+    ) -> tuple[list[dict[str, Any]], dict[str, dict[str, Any]]]:
+        """
+        Run each job (a dict of `run_model` keyword arguments) and return the
+        per-job results, in the same order as `jobs`, and per-host stats.
+        """
+        start = time.monotonic()
+        self.prepare_hosts()
+        slots = sum(h.max_concurrency for h in self.hosts)
+        with ThreadPoolExecutor(max_workers=slots) as executor:
+            results = list(executor.map(self.run_job, jobs))
+        wall_time = time.monotonic() - start
+
+        stats = {h.base_url: h.stats(wall_time) for h in self.hosts}
+        return results, stats
@@ -18,6 +18,8 @@ def get_appdata() -> str:
 
 
 REGISTRY_DIR = os.path.join(get_appdata(), "registry.json")
+# compiled R packages, one library per base image, reused across builds
+R_LIBRARY_DIR = os.path.join(get_appdata(), "r-library")
 
 
 def register_model(path: str, image: str, manifest: dict):
@@ -0,0 +1,133 @@
+import io
+import requests
+import socket
+import tarfile
+from eratos_docker import build
+from eratos_docker.build import (
+    cache_r_library,
+    parse_dcf,
+    serve_r_cache,
+    write_r_install_script,
+)
+
+CACHE_URL = f"http://host.docker.internal:{build.R_CACHE_PORT}"
+DESCRIPTIONS = {
+    "sf": "Package: sf\nVersion: 1.0-16\nImports: classInt (>= 0.4-1),\n    DBI\nLinkingTo: Rcpp\nBuilt: R 4.3.3; x86_64-pc-linux-gnu; 2024-05-01\n",
+    "DBI": "Package: DBI\nVersion: 1.2.2\nDepends: methods, R (>= 3.0.0)\n",
+}
+
+
+class FakeClient:
+    def __init__(self, packages):
+        self.packages = packages
+        self.archived = []
+        self.removed = []
+
+    def create_container(self, image):
+        return {"Id": "container"}
+
+    def get_archive(self, container, path):
+        self.archived.append(path)
+        name = path.rpartition("/")[2]
+        packages = self.packages if name == "r-lib" else [name]
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for package in packages:
+                prefix = f"r-lib/{package}" if name == "r-lib" else package
+                for filename, content in [
+                    ("R/sf.rdb", b"\0" * 1000),
+                    ("DESCRIPTION", DESCRIPTIONS[package].encode("utf-8")),
+                ]:
+                    info = tarfile.TarInfo(f"{prefix}/{filename}")
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+        data = buffer.getvalue()
+        # docker streams archives in chunks
+        return (data[i : i + 100] for i in range(0, len(data), 100)), {}
+
+    def remove_container(self, container, v=False, force=False):
+        self.removed.append(container)
+
+
+def test_install_script_binary_repo(tmp_path):
+    script = tmp_path / "install.R"
+    write_r_install_script(script, ["sf", "terra"], build.R_REPO, True, CACHE_URL)
+    text = script.read_text()
+
+    assert 'pkgs <- c("sf", "terra")' in text
+    assert "__linux__" in text
+    assert f'repos <- c(cache = "{CACHE_URL}", CRAN = repo)' in text
+
+
+def test_install_script_plain_mirror(tmp_path):
+    script = tmp_path / "install.R"
+    write_r_install_script(script, ["sf"], "https://mirror.example/cran/", True)
+    text = script.read_text()
+
+    # only package manager instances have binary repositories
+    assert "__linux__" not in text
+    assert "repos <- c(CRAN = repo)" in text
+
+
+def test_parse_dcf():
+    fields = parse_dcf(DESCRIPTIONS["sf"])
+
+    assert fields["Version"] == "1.0-16"
+    assert fields["Imports"] == "classInt (>= 0.4-1), DBI"
+
+
+def test_cache_r_library(tmp_path):
+    client = FakeClient(["sf", "DBI"])
+    cache_r_library(client, "model:latest", tmp_path)
+    contrib = tmp_path / "src" / "contrib"
+
+    assert sorted(p.name for p in contrib.iterdir()) == [
+        "DBI_1.2.2.tar.gz",
+        "PACKAGES",
+        "sf_1.0-16.tar.gz",
+    ]
+    with tarfile.open(contrib / "sf_1.0-16.tar.gz") as tar:
+        assert sorted(tar.getnames()) == ["sf/DESCRIPTION", "sf/R/sf.rdb"]
+    index = (contrib / "PACKAGES").read_text()
+    assert "Package: sf\nVersion: 1.0-16\nImports: classInt (>= 0.4-1), DBI\n" in index
+    assert "Built" not in index
+    assert client.removed == ["container"]
+
+
+def test_cache_r_library_skips_cached(tmp_path):
+    cache_r_library(FakeClient(["DBI"]), "model:latest", tmp_path)
+    contrib = tmp_path / "src" / "contrib"
+    index_mtime = (contrib / "PACKAGES").stat().st_mtime_ns
+
+    # a rebuild with nothing new only reads the package versions
+    client = FakeClient(["DBI"])
+    cache_r_library(client, "model:latest", tmp_path)
+    assert client.archived == [build.R_LIBRARY]
+    assert (contrib / "PACKAGES").stat().st_mtime_ns == index_mtime
+
+    client = FakeClient(["sf", "DBI"])
+    cache_r_library(client, "other:latest", tmp_path)
+    assert client.archived == [build.R_LIBRARY, f"{build.R_LIBRARY}/sf"]
+    assert "Package: sf" in (contrib / "PACKAGES").read_text()
+
+
+def test_serve_r_cache(tmp_path):
+    cache_r_library(FakeClient(["DBI"]), "model:latest", tmp_path)
+    httpd = serve_r_cache(tmp_path, build.R_CACHE_PORT)
+    try:
+        response = requests.get(
+            f"http://localhost:{build.R_CACHE_PORT}/src/contrib/PACKAGES"
+        )
+        response.raise_for_status()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert "Package: DBI" in response.text
+
+
+def test_serve_r_cache_port_in_use(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(("0.0.0.0", 0))
+        sock.listen()
+        assert serve_r_cache(tmp_path, sock.getsockname()[1]) is None
@@ -0,0 +1,131 @@
+import cProfile
+import docker
+import io
+import pytest
+import tarfile
+import threading
+from eratos_docker.mock_analysis import MockAnalysisService
+from eratos_docker.run import (
+    PROFILE_BASE_LABEL,
+    ModelRunner,
+    summarise_cprofile,
+    summarise_pyspy,
+)
+
+
+class FakeClient:
+    def __init__(self, files, images=None):
+        self.files = files
+        self.images = images if images is not None else {}
+        self.builds = []
+
+    def inspect_image(self, image):
+        if image not in self.images:
+            raise docker.errors.ImageNotFound(image)
+        return self.images[image]
+
+    def build(self, tag, labels, **kwargs):
+        self.builds.append(tag)
+        self.images[tag] = {"Id": "profile", "Config": {"Labels": labels}}
+        return iter([])
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_container(self, image, **kwargs):
+        raise docker.errors.APIError("port is already allocated")
+
+    def get_archive(self, container, path):
+        if path not in self.files:
+            raise docker.errors.NotFound(path)
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            info = tarfile.TarInfo(path.rpartition("/")[2])
+            info.size = len(self.files[path])
+            tar.addfile(info, io.BytesIO(self.files[path]))
+        return iter([buffer.getvalue()]), {}
+
+
+def runner(docker_client):
+    # skip the registry lookup, only the docker client is needed here
+    model_runner = ModelRunner.__new__(ModelRunner)
+    model_runner.docker_client = docker_client
+    model_runner.profiling_image_lock = threading.Lock()
+    model_runner.image_name = "models/simple"
+    return model_runner
+
+
+def busy():
+    return sum(i * i for i in range(100000))
+
+
+def test_summarise_cprofile(tmp_path):
+    path = tmp_path / "model.prof"
+    profiler = cProfile.Profile()
+    profiler.runcall(busy)
+    profiler.dump_stats(path)
+    functions = summarise_cprofile(path, 2)
+
+    assert len(functions) == 2
+    assert functions[0]["self_time"] >= functions[1]["self_time"]
+    assert any("busy" in f["function"] for f in summarise_cprofile(path, 10))
+
+
+def test_summarise_pyspy(tmp_path):
+    path = tmp_path / "model.txt"
+    # py-spy --format raw --nolineno output
+    path.write_text(
+        "<module> (as_models/host.py);run (model.py);slow (model.py) 60\n"
+        "<module> (as_models/host.py);run (model.py);slow (model.py) 20\n"
+        "<module> (as_models/host.py);run (model.py) 15\n"
+        "<module> (as_models/host.py);poll (host.py) 5\n"
+    )
+    functions = summarise_pyspy(path, 3)
+
+    assert [f["function"] for f in functions] == [
+        "slow (model.py)",
+        "run (model.py)",
+        "poll (host.py)",
+    ]
+    assert functions[0]["self_samples"] == 80
+    assert functions[0]["self_percent"] == 80.0
+    assert functions[1]["total_samples"] == 95
+
+
+def test_copy_profile(tmp_path):
+    model_runner = runner(FakeClient({"/tmp/model.prof": b"profile"}))
+    model_runner.copy_profile("container", "model.prof", tmp_path)
+    assert (tmp_path / "model.prof").read_bytes() == b"profile"
+
+    # a model that never wrote its profile
+    model_runner.copy_profile("container", "missing.prof", tmp_path)
+    assert not (tmp_path / "missing.prof").exists()
+
+
+def test_failed_start_frees_analysis_port(tmp_path):
+    model_runner = runner(FakeClient({}))
+    model_runner.model_path = tmp_path
+    model_runner.model_ids = ["model"]
+    model_runner.models = {"model": {"id": "model", "ports": []}}
+
+    with pytest.raises(docker.errors.APIError):
+        model_runner.run_model(analysis_service_port=19100)
+    # the port is free again for the next job
+    MockAnalysisService(19100).server_close()
+
+
+def test_profiling_image_built_once():
+    client = FakeClient({}, images={"models/simple": {"Id": "v1"}})
+    model_runner = runner(client)
+
+    assert model_runner.build_profiling_image() == "models/simple:profile"
+    model_runner.build_profiling_image()
+    assert client.builds == ["models/simple:profile"]
+    labels = client.images["models/simple:profile"]["Config"]["Labels"]
+    assert labels == {PROFILE_BASE_LABEL: "v1"}
+
+    # rebuilt once the model image changes
+    client.images["models/simple"] = {"Id": "v2"}
+    model_runner.build_profiling_image()
+    model_runner.build_profiling_image()
+    assert client.builds == ["models/simple:profile"] * 2
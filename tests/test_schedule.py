@@ -0,0 +1,251 @@
+import docker
+import pytest
+import requests
+import threading
+import time
+from eratos_docker import schedule
+from eratos_docker.schedule import DockerHost, ModelScheduler
+
+IMAGE = "models/simple"
+
+
+class FakeClient:
+    """Just enough of docker.APIClient for the scheduler."""
+
+    def __init__(self, base_url, images=(IMAGE,), alive=True, run=None):
+        self.base_url = base_url
+        self.images = set(images)
+        self.alive = alive
+        self.run = run
+        self.loaded = False
+        self.pulled = []
+
+    def inspect_image(self, image):
+        if image not in self.images:
+            raise docker.errors.ImageNotFound(image)
+        return {"Id": image}
+
+    def get_image(self, image):
+        return iter([b"image tarball"])
+
+    def load_image(self, data):
+        list(data)
+        self.loaded = True
+        self.images.add(IMAGE)
+
+    def pull(self, repository, tag=None):
+        self.pulled.append((repository, tag))
+        raise docker.errors.APIError(f"{repository}:{tag} not found")
+
+    def ping(self):
+        if not self.alive:
+            raise requests.ConnectionError("host is down")
+        return True
+
+
+class FakeRunner:
+    def __init__(self, model_path, docker_client):
+        self.docker_client = docker_client
+
+    def run_model(self, **kwargs):
+        if self.docker_client.run is not None:
+            self.docker_client.run(kwargs)
+        result_docs = {"host": self.docker_client.base_url, **kwargs}
+        if kwargs.get("profile", False):
+            return result_docs, None, {"functions": []}
+        return result_docs, None
+
+
+def dead_host(kwargs):
+    raise requests.ConnectionError("connection refused")
+
+
+@pytest.fixture
+def make_scheduler(tmp_path, monkeypatch):
+    monkeypatch.setattr(schedule, "get_registry_entry", lambda path: {"image": IMAGE})
+    monkeypatch.setattr(schedule, "ModelRunner", FakeRunner)
+
+    def make(hosts, **kwargs):
+        return ModelScheduler(
+            tmp_path, hosts, source_client=FakeClient("local"), **kwargs
+        )
+
+    return make
+
+
+def host(name, max_concurrency=1, **kwargs):
+    return DockerHost(
+        f"tcp://{name}:2375", max_concurrency, docker_client=FakeClient(name, **kwargs)
+    )
+
+
+def test_host_address():
+    assert schedule.get_host_address("tcp://10.0.0.5:2375") == "10.0.0.5"
+    assert schedule.get_host_address("unix://var/run/docker.sock") == "localhost"
+    assert schedule.get_host_address("npipe:////./pipe/docker_engine") == "localhost"
+
+
+def test_least_loaded_placement(make_scheduler):
+    a, b = host("a", 2), host("b", 4)
+    scheduler = make_scheduler([a, b])
+    placed = [scheduler.acquire() for _ in range(4)]
+
+    # ties go to the first host, then whichever has the lowest active / capacity
+    assert [h for h, _, _ in placed] == [a, b, b, a]
+    assert len({(h, port) for h, port, _ in placed}) == 4
+    assert len({analysis_port for _, _, analysis_port in placed}) == 4
+
+
+def test_retry_on_another_host(make_scheduler):
+    a = host("a", alive=False, run=dead_host)
+    b = host("b")
+    scheduler = make_scheduler([a, b])
+    results, stats = scheduler.run_batch([{"initial_ports": {"input0": "1"}}])
+
+    assert results[0]["error"] is None
+    assert results[0]["host"] == b.base_url
+    assert results[0]["attempts"] == 2
+    assert results[0]["result_docs"]["model_host"] == "b"
+    assert not a.healthy
+    assert stats[a.base_url]["failed"] == 1
+    assert stats[a.base_url]["last_error"] == "ConnectionError: connection refused"
+    assert stats[b.base_url]["completed"] == 1
+
+
+def test_profile_summary(make_scheduler):
+    scheduler = make_scheduler([host("a")])
+    results, _ = scheduler.run_batch([{}, {"profile": True}])
+
+    assert results[0]["profile"] is None
+    assert results[1]["profile"] == {"functions": []}
+    assert all(r["error"] is None for r in results)
+
+
+def test_job_failure_keeps_host(make_scheduler):
+    def run(kwargs):
+        if kwargs["initial_ports"]["input0"] == "bad":
+            raise requests.ConnectionError("model did not start")
+
+    a = host("a", run=run)
+    scheduler = make_scheduler([a])
+    jobs = [{"initial_ports": {"input0": x}} for x in ["1", "bad", "2"]]
+    results, stats = scheduler.run_batch(jobs)
+
+    assert a.healthy
+    assert [r["error"] is None for r in results] == [True, False, True]
+    assert "model did not start" in results[1]["error"]
+    # the model is at fault, so it isn't retried elsewhere
+    assert results[1]["attempts"] == 1
+    assert stats[a.base_url]["completed"] == 2
+    assert stats[a.base_url]["failed"] == 1
+
+
+def test_bad_job_does_not_end_batch(make_scheduler):
+    def run(kwargs):
+        if kwargs["initial_ports"] is None:
+            raise KeyError("Invalid model id")
+
+    scheduler = make_scheduler([host("a", run=run)])
+    results, _ = scheduler.run_batch([{"initial_ports": None}, {"initial_ports": {}}])
+
+    assert "KeyError" in results[0]["error"]
+    assert results[1]["error"] is None
+
+
+def test_all_hosts_unhealthy(make_scheduler):
+    hosts = [host(name, alive=False, run=dead_host) for name in "abc"]
+    scheduler = make_scheduler(hosts, max_retries=5)
+    results, stats = scheduler.run_batch([{}, {}])
+
+    for result in results:
+        assert "No healthy docker hosts available" in result["error"]
+    assert not any(s["healthy"] for s in stats.values())
+    with pytest.raises(RuntimeError):
+        scheduler.acquire()
+
+
+def test_ports_released(make_scheduler):
+    running = []
+    collisions = []
+    lock = threading.Lock()
+
+    def run(kwargs):
+        # assertions here would just be reported as job errors, so record clashes
+        ports = [
+            (kwargs["model_host"], kwargs["model_port"]),
+            ("local", kwargs["analysis_service_port"]),
+        ]
+        with lock:
+            collisions.extend(p for p in ports if p in running)
+            running.extend(ports)
+        time.sleep(0.01)
+        with lock:
+            for p in ports:
+                running.remove(p)
+        if kwargs["initial_ports"]["input0"] % 3 == 0:
+            raise ValueError("bad input")
+
+    a, b = host("a", 2, run=run), host("b", 3, run=run)
+    scheduler = make_scheduler([a, b], analysis_service_port=19000)
+    scheduler.run_batch([{"initial_ports": {"input0": i}} for i in range(20)])
+
+    assert collisions == []
+    assert sorted(a.free_ports) == [28080, 28081]
+    assert sorted(b.free_ports) == [28080, 28081, 28082]
+    assert sorted(scheduler.free_analysis_ports) == list(range(19000, 19005))
+    assert a.active == b.active == 0
+
+
+def test_image_loaded_onto_hosts(make_scheduler):
+    a = host("a")
+    b = host("b", images=())
+    scheduler = make_scheduler([a, b])
+    scheduler.prepare_hosts()
+
+    assert not a.docker_client.loaded
+    assert b.docker_client.loaded
+    assert a.healthy and b.healthy
+
+
+def test_missing_image_marks_host_unhealthy(make_scheduler):
+    a = host("a")
+    b = host("b", images=())
+    scheduler = make_scheduler([a, b])
+    scheduler.source_client.images.clear()
+    scheduler.prepare_hosts()
+
+    assert a.healthy
+    assert not b.healthy
+    assert "not found" in b.last_error
+
+
+def test_pull_keeps_registry_port():
+    client = FakeClient("a", images=())
+    with pytest.raises(docker.errors.APIError):
+        schedule.ensure_image("registry:5000/models/simple", client)
+
+    assert client.pulled == [("registry:5000/models/simple", "latest")]
+
+
+def test_unreachable_host(make_scheduler):
+    # nothing listens on port 1, the host should only fail once the batch starts
+    down = DockerHost("tcp://127.0.0.1:1")
+    up = host("up")
+    scheduler = make_scheduler([down, up])
+    results, _ = scheduler.run_batch([{}])
+
+    assert not down.healthy
+    assert down.last_error is not None
+    assert results[0]["host"] == up.base_url
+    assert results[0]["error"] is None
+
+
+def test_stats():
+    h = host("a", 2)
+    h.busy_time = 15.0
+    h.completed = 3
+    stats = h.stats(10.0)
+
+    assert stats["utilisation"] == pytest.approx(0.75)
+    assert stats["completed"] == 3
+    assert h.stats(0.0)["utilisation"] == 0.0